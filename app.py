@@ -1,31 +1,76 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session, g, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import MetaData, event, insert, inspect, or_, select
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import load_only
+from sqlalchemy.pool import QueuePool
 from werkzeug.utils import secure_filename
 import os
-from datetime import datetime
+import sys
+from urllib.parse import quote
+from datetime import datetime, timedelta
 from stitch_content import ContentStitcher
 import fitz  # PyMuPDF
 import json
+import sqlite3
+import threading
+import time
+import atexit
+import redis
 import shutil
+import tempfile
+import gzip
+import hashlib
+import multiprocessing
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from auth import auth
-from models import db, User, Book  # Import Book from models
-from config import FLASK_SECRET_KEY
+from models import db, User, Book, UserBookProgress  # Import Book from models
+from config import FLASK_SECRET_KEY, USE_X_SENDFILE, X_ACCEL_REDIRECT_PREFIX, REDIS_URL, REDIS_SOCKET_TIMEOUT, PDF_EXTRACT_WORKERS, PDFJS_INTEGRITY, PDFJS_WORKER_INTEGRITY
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps
+from cachetools import TTLCache
+from uuid import uuid4
+from tasks import process_pdf_task
 
-# Get base directory
+# Get base directory and the data directories under it, joined once
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-
-# Configure detailed logging
+UPLOAD_DIR = os.path.join(BASE_DIR, 'uploads')
+OUTPUTS_DIR = os.path.join(BASE_DIR, 'outputs')
+STITCHED_DIR = os.path.join(BASE_DIR, 'stitched_content')
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+
+# Configure logging (LOG_LEVEL=DEBUG for detailed output). Records are handed
+# to a queue and written by a listener thread, so request threads never wait
+# on the log file. force=True replaces the handlers stitch_content installed.
+# Write to the real stderr: in Celery workers sys.stderr is a proxy that logs
+# back to the root logger, which would feed every record around forever.
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
+log_handlers = [
+    logging.FileHandler(os.path.join(BASE_DIR, 'app.log')),
+    logging.StreamHandler(sys.__stderr__)
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers)
+queue_handler = QueueHandler(log_queue)
+# Only merge args into the message here; the listener's handlers add the rest
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(BASE_DIR, 'app.log')),
-        logging.StreamHandler()
-    ]
+    level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO),
+    handlers=[queue_handler],
+    force=True
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
+# Skip per-request access lines (the reader polls the status endpoint)
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET_KEY
@@ -35,76 +80,392 @@ app.register_blueprint(auth, url_prefix='/auth')
 
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(BASE_DIR, "books.db")}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'uploads')
+# Keep SQLite connections open between requests instead of reconnecting (and
+# re-running the PRAGMAs below) every time
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 10,
+    'max_overflow': 20,
+    # Drop connections that went stale or were left open for too long
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'connect_args': {'check_same_thread': False, 'timeout': 30}
+}
+app.config['UPLOAD_FOLDER'] = UPLOAD_DIR
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
 
 # Ensure upload directories exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(os.path.join(BASE_DIR, 'outputs'), exist_ok=True)
-os.makedirs(os.path.join(BASE_DIR, 'stitched_content'), exist_ok=True)
-os.makedirs(os.path.join(BASE_DIR, 'data'), exist_ok=True)
+for directory in (UPLOAD_DIR, OUTPUTS_DIR, STITCHED_DIR, DATA_DIR):
+    os.makedirs(directory, exist_ok=True)
 
 # Initialize SQLAlchemy with app
 db.init_app(app)
 
+# Shared across requests; ContentStitcher holds no per-call state
+content_stitcher = ContentStitcher()
+
+# Plain text extraction: clip to the page but skip ligature and whitespace
+# preservation, since the output is only split into words downstream.
+# flags=0 is only ~10% faster and would let off-page text into the book;
+# "blocks" extraction is slower than "text".
+TEXT_FLAGS = fitz.TEXT_MEDIABOX_CLIP
+# Pages between MuPDF store evictions while extracting
+STORE_SHRINK_PAGES = 50
+# Smaller PDFs are extracted in-process; a pool isn't worth starting for them
+PARALLEL_MIN_PAGES = 32
+# Pages extracted per process pool task
+PARALLEL_RANGE_PAGES = 16
+# Uploads with more pages than this are rejected
+MAX_PDF_PAGES = 10000
+# A processing task still unfinished after this long is presumed lost (its
+# worker was killed, or it was never queued)
+TASK_TIMEOUT = timedelta(hours=1)
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL journaling and larger caches on every SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+    cursor.execute("PRAGMA cache_size=-64000")  # 64MB
+    cursor.close()
+
+def books_schema_changes(connection):
+    """Columns missing from an existing books table, and whether user_id must lose NOT NULL"""
+    columns = {column['name']: column for column in inspect(connection).get_columns('books')}
+    missing = [column for column in Book.__table__.columns if column.name not in columns]
+    return columns, missing, not columns['user_id']['nullable']
+
+def upgrade_schema():
+    """Bring a books.db from an older version up to the current schema in place"""
+    if not inspect(db.engine).has_table('books'):
+        return
+    with db.engine.connect() as connection:
+        if not any(books_schema_changes(connection)[1:]):
+            return
+
+    # Use the DBAPI connection directly so the whole upgrade runs in one
+    # BEGIN IMMEDIATE transaction; other workers wait, then find nothing to do
+    raw = db.engine.raw_connection()
+    sqlite_connection = raw.connection
+    sqlite_connection.isolation_level = None
+    try:
+        cursor = sqlite_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        with db.engine.connect() as connection:
+            columns, missing, user_id_not_null = books_schema_changes(connection)
+        if user_id_not_null:
+            # SQLite can't drop NOT NULL, so copy the rows into a new table
+            logger.info("Rebuilding books table to allow shared books (user_id NULL)")
+            metadata = MetaData()
+            User.__table__.to_metadata(metadata)  # for the user_id foreign key
+            new_table = Book.__table__.to_metadata(metadata, name='books_new')
+            cursor.execute(str(CreateTable(new_table).compile(db.engine)))
+            copied = ', '.join(f'"{name}"' for name in columns if name in new_table.columns)
+            cursor.execute(f"INSERT INTO books_new ({copied}) SELECT {copied} FROM books")
+            cursor.execute("DROP TABLE books")
+            cursor.execute("ALTER TABLE books_new RENAME TO books")
+        else:
+            for column in missing:
+                logger.info(f"Adding books.{column.name} column")
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                cursor.execute(f'ALTER TABLE books ADD COLUMN "{column.name}" {column_type}')
+        cursor.execute("COMMIT")
+    except Exception:
+        if sqlite_connection.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        sqlite_connection.isolation_level = ''
+        raw.close()
+
 # Initialize default book content if not exists
 def init_default_books():
-    data_dir = os.path.join(BASE_DIR, 'data')
-    os.makedirs(data_dir, exist_ok=True)
-    
     default_content = {
-        'philosophia_ultima.txt': os.path.join(BASE_DIR, 'stitched_content', 'Philosophia_Ultima.txt'),
-        'cycles_the_science_of_prediction.txt': os.path.join(BASE_DIR, 'stitched_content', 'Cycles—The Science of Prediction, Edward R. Dewey.txt')
+        'philosophia_ultima.txt': os.path.join(STITCHED_DIR, 'Philosophia_Ultima.txt'),
+        'cycles_the_science_of_prediction.txt': os.path.join(STITCHED_DIR, 'Cycles—The Science of Prediction, Edward R. Dewey.txt')
     }
     
     for target_file, source_file in default_content.items():
-        target_path = os.path.join(data_dir, target_file)
-        if not os.path.exists(target_path) and os.path.exists(source_file):
-            shutil.copy2(source_file, target_path)
-            logger.info(f"Copied default book content to {target_path}")
-
-# Initialize database and default books
-with app.app_context():
-    db.create_all()
-    init_default_books()
-    logger.info("Database initialized")
-
-@app.after_request
-def add_security_headers(response):
-    """Add security headers including CSP"""
-    # Add CSP header with more permissive but still secure settings
-    response.headers['Content-Security-Policy'] = (
+        target_path = os.path.join(DATA_DIR, target_file)
+        if stat_or_none(target_path) is None and stat_or_none(source_file) is not None:
+            # The content is read-only, so share the inode instead of copying
+            try:
+                os.link(source_file, target_path)
+            except OSError:
+                shutil.copy2(source_file, target_path)
+            logger.info(f"Linked default book content to {target_path}")
+
+# Security headers, built once rather than on every response
+SECURITY_HEADERS = {
+    # CSP with more permissive but still secure settings
+    'Content-Security-Policy': (
         "default-src 'self'; "
-        "script-src 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.tailwindcss.com; "  # Allow Tailwind and necessary JS
-        "style-src 'self' 'unsafe-inline' https://cdn.tailwindcss.com https://cdn.jsdelivr.net; "  # Allow Tailwind CSS
+        "script-src 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.tailwindcss.com https://cdn.jsdelivr.net/npm/pdfjs-dist@3.11.174/; "  # Allow Tailwind, pdf.js and necessary JS
+        "style-src 'self' 'unsafe-inline' https://cdn.tailwindcss.com; "  # Allow Tailwind CSS
         "img-src 'self' data: blob:; "  # Allow data URLs for images
         "font-src 'self' data: https://cdn.tailwindcss.com; "  # Allow fonts
-        "connect-src 'self' https://cdn.tailwindcss.com; "  # Allow connections to Tailwind
+        "connect-src 'self' https://cdn.tailwindcss.com https://cdn.jsdelivr.net/npm/pdfjs-dist@3.11.174/; "  # Allow connections to Tailwind and the pdf.js worker
         "worker-src 'self' blob:; "  # Allow web workers
         "frame-src 'self'; "  # Allow iframes from same origin
         "object-src 'none'; "  # Disable object/embed tags
         "base-uri 'self'"  # Restrict base URI
-    )
-    # Add other security headers
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'SAMEORIGIN'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
+    ),
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'SAMEORIGIN',
+    'X-XSS-Protection': '1; mode=block',
+    'Referrer-Policy': 'strict-origin-when-cross-origin'
+}
+
+@app.after_request
+def add_security_headers(response):
+    """Add security headers including CSP"""
+    response.headers.update(SECURITY_HEADERS)
     return response
 
+# Short-lived caches for the reader's read-heavy endpoints. Books are cached
+# as ORM objects and merged into the current session without a SELECT; the
+# status endpoint caches just its (status, word_count) result.
+_book_cache = TTLCache(maxsize=1024, ttl=5)
+_status_cache = TTLCache(maxsize=1024, ttl=5)
+_cache_lock = threading.Lock()
+
+# Finished books' status is also cached in Redis so every web worker shares
+# it, and the Celery worker can invalidate it when it reprocesses a book
+redis_client = redis.Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT
+)
+SHARED_STATUS_TTL = 3600
+
+# Whether the last Redis call failed. Every poll touches Redis, so an outage
+# is logged as a warning once and then at DEBUG until it recovers.
+_redis_failing = False
+
+def redis_failed(action, e):
+    """Log a failed Redis call, warning only on the first failure of an outage"""
+    global _redis_failing
+    if _redis_failing:
+        logger.debug(f"Redis {action} failed: {str(e)}")
+    else:
+        _redis_failing = True
+        logger.warning(f"Redis {action} failed: {str(e)} (further failures are logged at DEBUG)")
+
+def redis_succeeded():
+    """Note a successful Redis call, ending any outage"""
+    global _redis_failing
+    if _redis_failing:
+        _redis_failing = False
+        logger.info("Redis is reachable again")
+
+def get_shared_status(book_id):
+    """Get a book's cached (status, word_count) from Redis, if any"""
+    try:
+        raw = redis_client.get(f'book:{book_id}:status')
+    except redis.RedisError as e:
+        redis_failed("status lookup", e)
+        return None
+    redis_succeeded()
+    return tuple(json.loads(raw)) if raw else None
+
+def set_shared_status(book_id, status):
+    """Cache a book's (status, word_count) in Redis"""
+    try:
+        redis_client.setex(f'book:{book_id}:status', SHARED_STATUS_TTL, json.dumps(status))
+    except redis.RedisError as e:
+        redis_failed("status update", e)
+        return
+    redis_succeeded()
+
+def load_book(book_id):
+    """Get a book by id (or 404), using the TTL cache when possible"""
+    with _cache_lock:
+        book = _book_cache.get(book_id)
+    if book is not None:
+        return db.session.merge(book, load=False)
+
+    # Only the columns the reader endpoints use; anything else loads on access
+    book = db.session.get(Book, book_id, options=[load_only(
+        Book.id, Book.title, Book.pdf_path, Book.text_path,
+        Book.word_count, Book.current_position, Book.processing_status, Book.task_id,
+        Book.upload_date
+    )])
+    if book is None:
+        abort(404)
+    with _cache_lock:
+        _book_cache[book_id] = book
+    return book
+
+# Paths recently seen to exist. Only hits are cached: a missing text file can
+# appear at any moment when a worker finishes, but files are never removed
+# (except a .gz copy that failed to rewrite; the content endpoint allows for it).
+_existing_paths = TTLCache(maxsize=4096, ttl=30)
+
+def path_exists(path):
+    """os.path.exists() that skips the stat for recently seen files"""
+    with _cache_lock:
+        if path in _existing_paths:
+            return True
+    if not os.path.exists(path):
+        return False
+    with _cache_lock:
+        _existing_paths[path] = True
+    return True
+
+def task_in_flight(book):
+    """Whether a Celery task is still working on a book"""
+    if book.processing_status not in ('pending', 'processing') or not book.task_id:
+        return False
+    if book.upload_date is not None and datetime.utcnow() - book.upload_date > TASK_TIMEOUT:
+        return False
+    try:
+        state = process_pdf_task.AsyncResult(book.task_id).state
+    except redis.RedisError as e:
+        # Can't ask the result backend; the age limit above still applies
+        redis_failed("task state lookup", e)
+        return True
+    redis_succeeded()
+    return state != 'FAILURE'
+
+def invalidate_book_cache(book_id):
+    """Drop cached entries for a book after it has been modified"""
+    with _cache_lock:
+        _book_cache.pop(book_id, None)
+        _status_cache.pop(book_id, None)
+    try:
+        redis_client.delete(f'book:{book_id}:status')
+    except redis.RedisError as e:
+        redis_failed("status invalidation", e)
+        return
+    redis_succeeded()
+
+def warm_pymupdf():
+    """Open and extract a tiny generated PDF so the first real one doesn't pay MuPDF's setup"""
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), "Flash Reader")
+        pdf_data = doc.tobytes()
+    with fitz.open(stream=pdf_data, filetype='pdf') as doc:
+        doc[0].get_text("text", flags=TEXT_FLAGS, sort=False)
+
+def extract_page_range(pdf_path, start, end):
+    """Extract the text of pages [start, end); runs in a worker process"""
+    with fitz.open(pdf_path, filetype='pdf') as doc:
+        texts = [
+            doc[page_num].get_text("text", flags=TEXT_FLAGS, sort=False)
+            for page_num in range(start, end)
+        ]
+    # Pool workers are reused, so don't let them accumulate cached objects
+    fitz.TOOLS.store_shrink(100)
+    return texts
+
+def iter_page_texts(pdf_path):
+    """Yield each page's text in order, fanning large PDFs out to a process pool"""
+    try:
+        yield from _iter_page_texts(pdf_path)
+    finally:
+        # The document is closed by now; release whatever MuPDF still caches
+        fitz.TOOLS.store_shrink(100)
+
+def _iter_page_texts(pdf_path):
+    with fitz.open(pdf_path, filetype='pdf') as doc:
+        page_count = len(doc)
+        # Celery's prefork children are daemonic and can't start a pool of
+        # their own; there the worker concurrency does the fan-out instead
+        if (page_count < PARALLEL_MIN_PAGES or PDF_EXTRACT_WORKERS < 2
+                or multiprocessing.current_process().daemon):
+            debug = logger.isEnabledFor(logging.DEBUG)
+            for page_num in range(page_count):
+                if debug:
+                    logger.debug("Processing page %d of %d", page_num + 1, page_count)
+                # Don't keep a Page reference around between iterations
+                yield doc[page_num].get_text("text", flags=TEXT_FLAGS, sort=False)
+                
+                # Evict MuPDF's cached objects periodically to bound memory
+                if (page_num + 1) % STORE_SHRINK_PAGES == 0:
+                    fitz.TOOLS.store_shrink(100)
+            return
+
+    # MuPDF extraction is CPU bound, so use processes rather than threads.
+    # Documents can't be pickled, so each task opens the PDF itself and
+    # extracts a whole range of pages to amortize the open.
+    logger.info(f"Extracting {page_count} pages with {PDF_EXTRACT_WORKERS} processes")
+    starts = range(0, page_count, PARALLEL_RANGE_PAGES)
+    with ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS) as executor:
+        ranges = executor.map(
+            extract_page_range,
+            [pdf_path] * len(starts),
+            starts,
+            [min(start + PARALLEL_RANGE_PAGES, page_count) for start in starts]
+        )
+        for texts in ranges:
+            yield from texts
+
+def stat_or_none(path):
+    """os.stat() result for path, or None if it doesn't exist"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+def count_words(path):
+    """Count whitespace-separated words in a text file without decoding it"""
+    count = 0
+    in_word = False
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            words = chunk.split()
+            count += len(words)
+            # Don't count a word split across two chunks twice
+            if words and in_word and not chunk[:1].isspace():
+                count -= 1
+            in_word = not chunk[-1:].isspace()
+    return count
+
+def write_gzip_copy(path):
+    """Write a precompressed path + '.gz' for the content endpoint to serve"""
+    # Unique temporary name: several workers may write the same copy at once
+    temp_path = None
+    try:
+        with open(path, 'rb') as src, tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path) or '.', suffix='.gz.part', delete=False
+        ) as tmp:
+            temp_path = tmp.name
+            with gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=tmp) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+        # Temporary files are created owner-only; nginx may need to read it
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path + '.gz')
+    except OSError as e:
+        # The uncompressed file is still served, so this isn't fatal
+        logger.warning(f"Could not write gzip copy of {path}: {str(e)}")
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        # An older copy would be served in place of the new text
+        with _cache_lock:
+            _existing_paths.pop(path + '.gz', None)
+        try:
+            os.remove(path + '.gz')
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not remove stale gzip copy of {path}: {str(e)}")
+
 def process_pdf(book_id):
     """Process the PDF and create the text version"""
     try:
         logger.info(f"Starting to process PDF for book_id: {book_id}")
         
-        book = Book.query.get(book_id)
+        book = db.session.get(Book, book_id)
         if not book:
             logger.error(f"Book not found with id: {book_id}")
             return False
 
-        # Update status
-        book.processing_status = 'processing'
-        db.session.commit()
         logger.info(f"Processing PDF file: {book.pdf_path}")
 
         # Verify PDF file exists
@@ -112,19 +473,19 @@ def process_pdf(book_id):
             logger.error(f"PDF file not found at path: {book.pdf_path}")
             raise FileNotFoundError(f"PDF file not found: {book.pdf_path}")
 
-        # Extract text using ContentStitcher
-        stitcher = ContentStitcher()
-        pdf_filename = os.path.basename(book.pdf_path)
-        json_filename = f"{os.path.splitext(pdf_filename)[0]}.json"
-        text_filename = f"{os.path.splitext(pdf_filename)[0]}.txt"
+        stem = os.path.splitext(os.path.basename(book.pdf_path))[0]
+        text_filename = f"{stem}.txt"
         text_path = os.path.join('stitched_content', text_filename)
         
         # Check if processed text already exists
         if os.path.exists(text_path):
             logger.info(f"Found existing processed text at: {text_path}")
-            with open(text_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                word_count = len(content.split())
+            # Reuse the count already stored for a book with this text
+            word_count = db.session.query(Book.word_count).filter(
+                Book.text_path == text_path, Book.word_count > 0
+            ).limit(1).scalar()
+            if word_count is None:
+                word_count = count_words(text_path)
             
             book.text_path = text_path
             book.word_count = word_count
@@ -132,63 +493,21 @@ def process_pdf(book_id):
             db.session.commit()
             return True
             
-        logger.info(f"Creating JSON file: {json_filename}")
-        
-        # First, extract text from PDF and create JSON
-        doc = fitz.open(book.pdf_path)
-        pages_data = []
-        
-        for page_num in range(len(doc)):
-            logger.debug(f"Processing page {page_num + 1} of {len(doc)}")
-            page = doc[page_num]
-            text = page.get_text()
-            
-            # Create the DeepSeek-style response
-            deepseek_response = {
-                "choices": [
-                    {
-                        "message": {
-                            "content": json.dumps({
-                                "content": text,
-                                "page": page_num + 1,
-                                "chapter": "",
-                                "words": text.split()
-                            })
-                        }
-                    }
-                ]
-            }
-            
-            # Create JSON structure for this page
-            page_data = {
-                "page_number": page_num + 1,
-                "deepseek_output": [deepseek_response]
-            }
-            pages_data.append(page_data)
-        
-        doc.close()
-        
-        # Save the JSON file
-        json_path = os.path.join('outputs', json_filename)
-        logger.debug(f"Saving JSON with {len(pages_data)} pages")
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(pages_data, f, ensure_ascii=False, indent=2)
-        
-        logger.info(f"JSON file created successfully at: {json_path}")
+        # Extract text from PDF and hand the pages straight to ContentStitcher;
+        # pages are generated lazily so only one is held in memory at a time
+        pages = (
+            {"page_number": page_num + 1, "text": text}
+            for page_num, text in enumerate(iter_page_texts(book.pdf_path))
+        )
         
-        # Process the file with ContentStitcher
         logger.info("Starting ContentStitcher processing")
-        stitcher.stitch_content(json_filename)
+        output_path = os.path.join(content_stitcher.output_dir, text_filename)
         
-        logger.info(f"Checking for processed text file at: {text_path}")
-        
-        if os.path.exists(text_path):
-            # Count words
-            with open(text_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                word_count = len(content.split())
-            
+        # stitch_pages counts the words as it writes them
+        word_count = content_stitcher.stitch_pages(pages, output_path)
+        if word_count is not None:
             logger.info(f"Text file processed successfully. Word count: {word_count}")
+            write_gzip_copy(output_path)
             
             # Update book record
             book.text_path = text_path
@@ -197,7 +516,7 @@ def process_pdf(book_id):
             db.session.commit()
             return True
         
-        logger.error("Text file was not created by ContentStitcher")
+        logger.error("ContentStitcher failed to create the text file")
         book.processing_status = 'failed'
         db.session.commit()
         return False
@@ -208,94 +527,124 @@ def process_pdf(book_id):
             book.processing_status = 'failed'
             db.session.commit()
         return False
+    finally:
+        invalidate_book_cache(book_id)
+
+# Books every user starts with; stored once with no owner and shared by all
+DEFAULT_BOOKS = [
+    {
+        'title': 'Philosophia Ultima',
+        'author': 'Osho',
+        'source_path': os.path.join(DATA_DIR, 'philosophia_ultima.txt')
+    },
+    {
+        'title': 'Cycles—The Science of Prediction',
+        'author': 'Edward R. Dewey',
+        'source_path': os.path.join(DATA_DIR, 'cycles_the_science_of_prediction.txt')
+    }
+]
+
+def init_shared_books():
+    """Create the shared default book rows that don't exist yet"""
+    titles = [book_data['title'] for book_data in DEFAULT_BOOKS]
+    existing_titles = {title for (title,) in db.session.query(Book.title).filter(
+        Book.user_id.is_(None),
+        Book.title.in_(titles)
+    )}
+
+    new_rows = []
+    for book_data in DEFAULT_BOOKS:
+        source_path = book_data['source_path']
+        if stat_or_none(source_path) is None:
+            continue
+        if stat_or_none(source_path + '.gz') is None:
+            write_gzip_copy(source_path)
+        if book_data['title'] not in existing_titles:
+            new_rows.append({
+                'title': book_data['title'],
+                'author': book_data['author'],
+                'text_path': source_path,
+                'user_id': None,
+                'processing_status': 'completed',
+                'word_count': count_words(source_path)
+            })
+            logger.info(f"Created shared default book {book_data['title']}")
+
+    if new_rows:
+        try:
+            db.session.execute(insert(Book), new_rows)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            # Another worker created them first; anything else is a real error
+            if 'UNIQUE constraint failed' not in str(e.orig):
+                raise
 
-def get_default_books(user_id):
-    # Create default books for the user if they don't exist
-    default_books = [
-        {
-            'title': 'Philosophia Ultima',
-            'author': 'Osho',
-            'source_path': os.path.join(BASE_DIR, 'data', 'philosophia_ultima.txt'),
-            'user_id': user_id
-        },
-        {
-            'title': 'Cycles—The Science of Prediction',
-            'author': 'Edward R. Dewey',
-            'source_path': os.path.join(BASE_DIR, 'data', 'cycles_the_science_of_prediction.txt'),
-            'user_id': user_id
-        }
-    ]
-
-    for book_data in default_books:
-        # Check if book already exists for this user
-        existing_book = Book.query.filter_by(
-            title=book_data['title'],
-            user_id=user_id
-        ).first()
-        
-        if not existing_book:
-            source_path = book_data['source_path']
-            if os.path.exists(source_path):
-                # Create user-specific directory if it doesn't exist
-                user_data_dir = os.path.join(BASE_DIR, 'data', str(user_id))
-                os.makedirs(user_data_dir, exist_ok=True)
-                
-                # Set up user-specific file path
-                filename = os.path.basename(source_path)
-                user_file = os.path.join(user_data_dir, filename)
-                
-                # Copy the content to user-specific file
-                shutil.copy2(source_path, user_file)
-                
-                # Calculate word count from the source file
-                with open(source_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    word_count = len(content.split())
-                
-                # Create book entry with user-specific path
-                book = Book(
-                    title=book_data['title'],
-                    author=book_data['author'],
-                    text_path=user_file,
-                    user_id=user_id,
-                    processing_status='completed',
-                    word_count=word_count
-                )
-                db.session.add(book)
-                logger.info(f"Created default book {book_data['title']} for user {user_id}")
-    
-    db.session.commit()
-    return Book.query.filter_by(user_id=user_id).all()
+# Initialize database and default books
+with app.app_context():
+    # Upgrade an existing books table first; create_all() adds new tables
+    upgrade_schema()
+    # Workers start together, so another one may create a table or index
+    # between the existence check and the CREATE
+    try:
+        db.create_all()
+        # create_all() skips indexes on tables that already exist
+        for index in Book.__table__.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    except OperationalError as e:
+        if 'already exists' not in str(e.orig):
+            raise
+        logger.info(f"Schema created by another worker: {e.orig}")
+    init_default_books()
+    init_shared_books()
+    logger.info("Database initialized")
+warm_pymupdf()
+
+@app.before_request
+def load_user_id():
+    """Read the signed-in user's id from the session once per request"""
+    g.user_id = session.get('user_id')
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if g.user_id is None:
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
 @app.route('/')
 def index():
-    if 'user_id' not in session:
+    if g.user_id is None:
         return redirect(url_for('login'))
-    # Get books for the current user
-    user_id = session['user_id']
-    default_books = get_default_books(user_id)
-    books = Book.query.filter_by(user_id=user_id).order_by(Book.upload_date.desc()).all()
-    return render_template('index.html', books=books)
+    # Get the user's books plus the shared defaults in one SELECT of just the
+    # columns the library listing renders
+    user_id = g.user_id
+    books = db.session.execute(
+        select(Book)
+        .options(load_only(
+            Book.id, Book.title, Book.author, Book.upload_date,
+            Book.processing_status, Book.word_count
+        ))
+        .where(or_(Book.user_id == user_id, Book.user_id.is_(None)))
+        .order_by(Book.upload_date.desc())
+    ).scalars().all()
+    return render_template(
+        'index.html',
+        books=books,
+        pdfjs_integrity=PDFJS_INTEGRITY,
+        pdfjs_worker_integrity=PDFJS_WORKER_INTEGRITY
+    )
 
 @app.route('/login', methods=['GET'])
 def login():
-    if 'user_id' in session:
-        # Ensure default books exist for logged-in user
-        get_default_books(session['user_id'])
+    if g.user_id is not None:
         return redirect(url_for('index'))
     return render_template('login.html')
 
 @app.route('/register')
 def register():
-    if 'user_id' in session:
+    if g.user_id is not None:
         return redirect(url_for('index'))
     return render_template('register.html')
 
@@ -315,8 +664,27 @@ def upload_file():
         logger.error("File is not a PDF")
         return jsonify({'error': 'File must be a PDF'}), 400
 
+    # Check the PDF signature before anything is written to disk
+    header = file.stream.read(5)
+    file.stream.seek(0)
+    if header != b'%PDF-':
+        logger.error("File does not have a PDF signature")
+        return jsonify({'error': 'File is not a valid PDF'}), 415
+
+    # Make sure MuPDF can open it before a worker is tied up with it
+    pdf_data = file.stream.read()
+    try:
+        with fitz.open(stream=pdf_data, filetype='pdf') as doc:
+            page_count = doc.page_count
+    except RuntimeError as e:
+        logger.error(f"Uploaded PDF could not be opened: {str(e)}")
+        return jsonify({'error': 'File is not a valid PDF'}), 400
+    if not 0 < page_count <= MAX_PDF_PAGES:
+        logger.error(f"Uploaded PDF has {page_count} pages")
+        return jsonify({'error': f'PDF must have between 1 and {MAX_PDF_PAGES} pages'}), 400
+
     try:
-        user_id = session['user_id']
+        user_id = g.user_id
         
         # Create user-specific upload directory
         user_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
@@ -326,45 +694,107 @@ def upload_file():
         filename = secure_filename(file.filename)
         pdf_path = os.path.join(user_upload_dir, filename)
         logger.info(f"Saving uploaded file to: {pdf_path}")
-        file.save(pdf_path)
+        with open(pdf_path, 'wb') as f:
+            f.write(pdf_data)
 
-        # Create book record
+        # Create book record, assigning the task id up front so the status
+        # endpoint can find the task as soon as the row is visible
+        task_id = str(uuid4())
         book = Book(
             title=os.path.splitext(filename)[0],
             pdf_path=pdf_path,
             processing_status='pending',
+            task_id=task_id,
             user_id=user_id
         )
         db.session.add(book)
         db.session.commit()
         logger.info(f"Created book record with id: {book.id} for user {user_id}")
-
-        # Process PDF
-        logger.info(f"Starting PDF processing for book id: {book.id}")
-        process_pdf(book.id)
+        book_data = book.to_dict()
+
+        # Queue PDF processing; the client polls /api/book/<id>/status
+        logger.info(f"Queueing PDF processing for book id: {book.id} (task {task_id})")
+        try:
+            process_pdf_task.apply_async(args=[book.id], task_id=task_id)
+        except Exception:
+            # Nothing will ever run this task, so don't leave the book pending
+            book.processing_status = 'failed'
+            db.session.commit()
+            raise
 
         return jsonify({
             'message': 'File uploaded successfully',
-            'book': book.to_dict()
+            'book': book_data
         })
 
     except Exception as e:
         logger.exception(f"Error in upload_file: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/book/text', methods=['POST'])
+@login_required
+def upload_text():
+    """Store a book whose text the browser already extracted from the PDF"""
+    data = request.get_json(silent=True) or {}
+    title = (data.get('title') or '').strip()[:200]
+    text = data.get('text')
+    if not title or not isinstance(text, str) or not text.strip():
+        return jsonify({'error': 'Title and text are required'}), 400
+
+    try:
+        user_id = g.user_id
+        # Titles repeat, so make the name unique rather than overwrite the
+        # text (and .gz copy) of an earlier book with the same title
+        filename = f"{secure_filename(title) or 'book'}-{uuid4().hex[:12]}"
+        user_text_dir = os.path.join(content_stitcher.output_dir, str(user_id))
+        os.makedirs(user_text_dir, exist_ok=True)
+        text_path = os.path.join(user_text_dir, f"{filename}.txt")
+
+        # Count server-side rather than trusting the client's number
+        word_count = content_stitcher.stitch_pages([{"page_number": 1, "text": text}], text_path)
+        if word_count is None:
+            return jsonify({'error': 'Failed to save text'}), 500
+        write_gzip_copy(text_path)
+
+        book = Book(
+            title=title,
+            text_path=text_path,
+            processing_status='completed',
+            word_count=word_count,
+            user_id=user_id
+        )
+        db.session.add(book)
+        db.session.commit()
+        logger.info(f"Created book record with id: {book.id} from client-extracted text")
+
+        return jsonify({
+            'message': 'Text uploaded successfully',
+            'book': book.to_dict()
+        })
+
+    except Exception as e:
+        logger.exception(f"Error in upload_text: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/book/<int:book_id>')
 @login_required
 def view_book(book_id):
-    book = Book.query.get_or_404(book_id)
-    return render_template('reader.html', book=book)
+    book = load_book(book_id)
+    return render_template('reader.html', book=book, position_flush_interval=POSITION_FLUSH_INTERVAL)
 
 @app.route('/api/book/<int:book_id>/content')
 def get_book_content(book_id):
-    book = Book.query.get_or_404(book_id)
+    book = load_book(book_id)
     
     # If text not available, try processing
-    if not book.text_path or not os.path.exists(book.text_path):
-        if book.pdf_path and os.path.exists(book.pdf_path):
+    if not book.text_path or not path_exists(book.text_path):
+        if task_in_flight(book):
+            # The Celery task owns this book; processing it here as well would
+            # race it on the same output file, so have the client retry
+            response = jsonify({'status': book.processing_status})
+            response.headers['Retry-After'] = '2'
+            return response, 202
+        if book.pdf_path and path_exists(book.pdf_path):
             logger.info(f"Text not found for book {book_id}, attempting to process PDF")
             success = process_pdf(book_id)
             if not success:
@@ -372,41 +802,191 @@ def get_book_content(book_id):
         else:
             return jsonify({'error': 'Text content not available'}), 404
 
-    with open(book.text_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
+    text_path = book.text_path
+    if X_ACCEL_REDIRECT_PREFIX:
+        # nginx sends the file itself (and the .gz copy via gzip_static),
+        # including conditional and Range handling
+        response = app.response_class(mimetype='text/plain')
+        relative_path = os.path.relpath(os.path.join(BASE_DIR, text_path), BASE_DIR)
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + quote(relative_path)
+        return response
+
+    # Prose compresses about 4x, so prefer the precompressed copy
+    gzip_path = text_path + '.gz'
+    use_gzip = 'gzip' in request.accept_encodings and path_exists(gzip_path)
+
+    # Stream the file rather than embedding it in JSON; conditional=True
+    # lets repeat loads be answered with 304 Not Modified via ETag/Last-Modified
+    try:
+        response = send_file(
+            gzip_path if use_gzip else text_path,
+            mimetype='text/plain',
+            conditional=True,
+            etag=True
+        )
+    except FileNotFoundError:
+        if not use_gzip:
+            raise
+        # Another worker removed a stale .gz this one still had cached
+        with _cache_lock:
+            _existing_paths.pop(gzip_path, None)
+        use_gzip = False
+        response = send_file(text_path, mimetype='text/plain', conditional=True, etag=True)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/api/book/<int:book_id>/meta')
+@login_required
+def get_book_meta(book_id):
+    book = load_book(book_id)
+    user_id = g.user_id
+    # A position this process hasn't flushed yet is newer than the database.
+    # One posted to another worker shows up here after its next flush; until
+    # then the reader prefers the position it saved locally.
+    with _pending_lock:
+        current_position = _pending_positions.get((user_id, book_id))
+    if current_position is None:
+        progress = db.session.get(UserBookProgress, (user_id, book_id))
+        # Books read before progress was tracked per user keep their old position
+        current_position = progress.position if progress else book.current_position or 0
     return jsonify({
-        'content': content,
         'word_count': book.word_count,
-        'current_position': book.current_position
+        'current_position': current_position
     })
 
 @app.route('/api/book/<int:book_id>/position', methods=['POST'])
+@login_required
 def update_position(book_id):
-    book = Book.query.get_or_404(book_id)
-    data = request.get_json()
+    book = load_book(book_id)
+    # force=True: the reader's unload beacon posts JSON as text/plain
+    data = request.get_json(force=True, silent=True) or {}
     
     if 'position' in data:
-        book.current_position = data['position']
-        db.session.commit()
+        position = data['position']
+        # Anything else would fail the whole batch when it is flushed
+        if not isinstance(position, int) or isinstance(position, bool) or position < 0:
+            return jsonify({'error': 'Position must be a non-negative integer'}), 400
+        with _pending_lock:
+            _pending_positions[(g.user_id, book.id)] = position
+        start_position_flusher()
         return jsonify({'success': True})
     
     return jsonify({'error': 'Position not provided'}), 400
 
+# Reading positions waiting to be written, keyed by (user_id, book_id). The
+# reader posts progress often, so positions are collected here and flushed
+# in one transaction per interval.
+_pending_positions = {}
+_pending_lock = threading.Lock()
+_position_flusher = None
+POSITION_FLUSH_INTERVAL = 5  # seconds
+
+def flush_positions():
+    """Write all pending reading positions with a single commit"""
+    with _pending_lock:
+        snapshot = _pending_positions.copy()
+        _pending_positions.clear()
+    if not snapshot:
+        return
+
+    try:
+        with app.app_context():
+            stmt = sqlite_insert(UserBookProgress)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'book_id'],
+                set_={'position': stmt.excluded.position}
+            )
+            db.session.execute(stmt, [
+                {'user_id': user_id, 'book_id': book_id, 'position': position}
+                for (user_id, book_id), position in snapshot.items()
+            ])
+            db.session.commit()
+    except OperationalError:
+        # Transient (e.g. the database is locked): put the positions back
+        # unless newer ones arrived meanwhile, and retry on the next flush
+        with _pending_lock:
+            for key, position in snapshot.items():
+                _pending_positions.setdefault(key, position)
+        raise
+    except Exception:
+        # Retrying a batch that can't be written would block every later
+        # position in this process, so drop it
+        logger.error(f"Dropping {len(snapshot)} reading positions that could not be written")
+        raise
+
+def run_position_flusher():
+    while True:
+        time.sleep(POSITION_FLUSH_INTERVAL)
+        try:
+            flush_positions()
+        except Exception as e:
+            logger.exception(f"Error flushing reading positions: {str(e)}")
+
+def start_position_flusher():
+    """Start the background flusher thread once per process"""
+    global _position_flusher
+    with _pending_lock:
+        if _position_flusher is None:
+            _position_flusher = threading.Thread(target=run_position_flusher, daemon=True)
+            _position_flusher.start()
+
+# Don't lose the last positions when the process exits
+atexit.register(flush_positions)
+
+# Celery task states mapped onto Book.processing_status values
+TASK_STATUS = {
+    'PENDING': 'pending',
+    'RECEIVED': 'pending',
+    'STARTED': 'processing',
+    'RETRY': 'processing',
+    'FAILURE': 'failed'
+}
+
 @app.route('/api/book/<int:book_id>/status')
 def get_processing_status(book_id):
-    book = Book.query.get_or_404(book_id)
-    return jsonify({
-        'status': book.processing_status,
-        'word_count': book.word_count
+    with _cache_lock:
+        cached = _status_cache.get(book_id)
+    if cached is None:
+        cached = get_shared_status(book_id)
+        if cached is None:
+            book = db.session.get(Book, book_id, options=[load_only(
+                Book.processing_status, Book.task_id, Book.word_count, Book.upload_date
+            )])
+            if book is None:
+                abort(404)
+            status = book.processing_status
+
+            # While the task is in flight the row still says 'pending', so ask Celery
+            if status in ('pending', 'processing') and book.task_id:
+                if book.upload_date is not None and datetime.utcnow() - book.upload_date > TASK_TIMEOUT:
+                    status = 'failed'
+                else:
+                    state = process_pdf_task.AsyncResult(book.task_id).state
+                    status = TASK_STATUS.get(state, status)
+
+            cached = (status, book.word_count)
+            # Only finished books are stable enough to share for long
+            if status in ('completed', 'failed'):
+                set_shared_status(book_id, cached)
+        with _cache_lock:
+            _status_cache[book_id] = cached
+
+    status, word_count = cached
+    response = jsonify({
+        'status': status,
+        'word_count': word_count
     })
+    # Let pollers revalidate cheaply; a completed book never changes again
+    response.set_etag(hashlib.blake2b(f'{status}:{word_count}'.encode(), digest_size=8).hexdigest())
+    if status == 'completed':
+        response.headers['Cache-Control'] = 'private, max-age=3600, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, max-age=1'
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
-    # Create required directories if they don't exist
-    os.makedirs('uploads', exist_ok=True)
-    os.makedirs('outputs', exist_ok=True)
-    os.makedirs('stitched_content', exist_ok=True)
-    
     # Get port from environment variable (for Replit) or use default
     port = int(os.environ.get('PORT', 5000))
     
@@ -52,9 +52,6 @@ def login():
         user = User.query.filter_by(email=email).first()
         if user and check_password_hash(user.password, password):
             session['user_id'] = user.id
-            # Create default books for the user
-            from app import get_default_books
-            get_default_books(user.id)
             return jsonify({'message': 'Login successful'}), 200
         
         return jsonify({'error': 'Invalid email or password'}), 401
@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from config import supabase
+from concurrent.futures import ThreadPoolExecutor
+from config import get_supabase
 import os
 import logging
 
@@ -53,7 +54,7 @@ class User(db.Model):
 
     @staticmethod
     def get_by_id(user_id):
-        return User.query.get(user_id)
+        return db.session.get(User, user_id)
 
     def to_dict(self):
         return {
@@ -73,11 +74,20 @@ class Book(db.Model):
     text_path = db.Column(db.String(500))
     word_count = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # NULL for the default books shared by every user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     processing_status = db.Column(db.String(20), default='pending')
+    task_id = db.Column(db.String(50))  # Celery task processing the PDF
     current_position = db.Column(db.Integer, default=0)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Serves the library listing: filter by user, newest first
+        db.Index('ix_book_user_upload', user_id, upload_date.desc()),
+        # Each shared default book is stored once
+        db.Index('ix_book_shared_title', title, unique=True, sqlite_where=user_id.is_(None)),
+    )
+
     @staticmethod
     def create(title, author, user_id, pdf_file=None, text_content=None, word_count=0):
         """Create a new book with optional PDF and text content"""
@@ -89,31 +99,37 @@ class Book(db.Model):
                 word_count=word_count
             )
             db.session.add(book)
+            # Commit before uploading so no database write transaction is
+            # held open across the network calls
             db.session.commit()
+            # Read the id here; the uploads below run on other threads
+            book_id = book.id
             
-            # Upload PDF if provided
-            if pdf_file:
-                def upload_pdf():
-                    pdf_path = f"pdfs/{book.id}.pdf"
-                    supabase.storage.from_(STORAGE_BUCKET).upload(
-                        pdf_path,
-                        pdf_file
-                    )
-                    return pdf_path
-                
-                book.pdf_path = handle_supabase_operation(upload_pdf)
+            def upload_pdf():
+                pdf_path = f"pdfs/{book_id}.pdf"
+                get_supabase().storage.from_(STORAGE_BUCKET).upload(
+                    pdf_path,
+                    pdf_file,
+                    file_options={'content-type': 'application/pdf'}
+                )
+                return pdf_path
             
-            # Upload text content if provided
-            if text_content:
-                def upload_text():
-                    text_path = f"texts/{book.id}.txt"
-                    supabase.storage.from_(STORAGE_BUCKET).upload(
-                        text_path,
-                        text_content.encode()
-                    )
-                    return text_path
-                
-                book.text_path = handle_supabase_operation(upload_text)
+            def upload_text():
+                text_path = f"texts/{book_id}.txt"
+                get_supabase().storage.from_(STORAGE_BUCKET).upload(
+                    text_path,
+                    text_content.encode()
+                )
+                return text_path
+            
+            # Upload the PDF and text content (if provided) concurrently
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                pdf_future = executor.submit(handle_supabase_operation, upload_pdf) if pdf_file else None
+                text_future = executor.submit(handle_supabase_operation, upload_text) if text_content else None
+                if pdf_future:
+                    book.pdf_path = pdf_future.result()
+                if text_future:
+                    book.text_path = text_future.result()
             
             if pdf_file or text_content:
                 db.session.commit()
@@ -130,7 +146,7 @@ class Book(db.Model):
             return None
             
         def get_url():
-            response = supabase.storage.from_(STORAGE_BUCKET).create_signed_url(
+            response = get_supabase().storage.from_(STORAGE_BUCKET).create_signed_url(
                 self.pdf_path,
                 3600  # URL valid for 1 hour
             )
@@ -144,7 +160,7 @@ class Book(db.Model):
             return None
             
         def get_content():
-            response = supabase.storage.from_(STORAGE_BUCKET).download(self.text_path)
+            response = get_supabase().storage.from_(STORAGE_BUCKET).download(self.text_path)
             return response.decode()
             
         return handle_supabase_operation(get_content)
@@ -152,16 +168,13 @@ class Book(db.Model):
     def update_text_content(self, text_content):
         """Update text content in storage"""
         try:
-            if self.text_path:
-                def remove_old():
-                    supabase.storage.from_(STORAGE_BUCKET).remove([self.text_path])
-                handle_supabase_operation(remove_old)
-            
+            # Upsert replaces any existing object in the same request
             def upload_new():
                 text_path = f"texts/{self.id}.txt"
-                supabase.storage.from_(STORAGE_BUCKET).upload(
+                get_supabase().storage.from_(STORAGE_BUCKET).upload(
                     text_path,
-                    text_content.encode()
+                    text_content.encode(),
+                    file_options={'x-upsert': 'true'}
                 )
                 return text_path
                 
@@ -184,6 +197,13 @@ class Book(db.Model):
             'user_id': self.user_id
         }
 
+class UserBookProgress(db.Model):
+    __tablename__ = 'user_book_progress'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+
 class ReadingProgress:
     def __init__(self, user_id, book_id, current_word=0, last_read=None):
         self.user_id = user_id
@@ -201,7 +221,7 @@ class ReadingProgress:
                 'current_word': current_word,
                 'last_read': datetime.utcnow().isoformat()
             }
-            response = supabase.table(TABLES['reading_progress']).upsert(progress_data).execute()
+            response = get_supabase().table(TABLES['reading_progress']).upsert(progress_data).execute()
             progress_data = response.data[0]
             return ReadingProgress(
                 progress_data['user_id'],
@@ -216,7 +236,7 @@ class ReadingProgress:
     def get_progress(user_id, book_id):
         """Get reading progress"""
         try:
-            response = supabase.table(TABLES['reading_progress']).select("*").eq('user_id', user_id).eq('book_id', book_id).execute()
+            response = get_supabase().table(TABLES['reading_progress']).select("*").eq('user_id', user_id).eq('book_id', book_id).execute()
             if response.data:
                 progress_data = response.data[0]
                 return ReadingProgress(
@@ -3,58 +3,212 @@ import json
 import os
 from typing import List, Tuple, Dict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import glob
+import hashlib
+import sys
+import tempfile
+import time
 from datetime import datetime
 import logging
+import atexit
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
+# Configure logging. Records are handed to a queue and written by a listener
+# thread in the main process, so the API threads and extraction processes
+# never wait on the log file.
+log_queue = multiprocessing.Queue(-1)
+queue_handler = QueueHandler(log_queue)
+# Only merge args into the message here; the listener's handlers add the rest
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+if multiprocessing.parent_process() is None:
+    log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    log_handlers = [
         logging.StreamHandler(),
         logging.FileHandler('pdf_processing.log')
     ]
-)
+    for handler in log_handlers:
+        handler.setFormatter(log_formatter)
+    log_listener = QueueListener(log_queue, *log_handlers)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def init_worker_logging(queue):
+    """Send a worker process's log records to the main process's listener"""
+    handler = QueueHandler(queue)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.getLogger().handlers = [handler]
 
 # Load environment variables
 load_dotenv()
 
+# Requests in flight at once across all pages of a PDF
+DEEPSEEK_CONCURRENCY = int(os.getenv("DEEPSEEK_CONCURRENCY", 16))
+# Seconds to wait for a response; a long completion can take minutes
+DEEPSEEK_READ_TIMEOUT = int(os.getenv("DEEPSEEK_READ_TIMEOUT", 300))
+
+# Responses are cached on disk by prompt, so re-running a PDF skips the API
+CACHE_DIR = os.path.expanduser(os.getenv("DEEPSEEK_CACHE_DIR", "~/.cache/deepseek"))
+CACHE_TTL = 30 * 86400  # seconds
+
+# Page text only feeds the chunker, so clip to the page but skip ligature
+# and whitespace preservation (same flags as the app's extractor)
+TEXT_FLAGS = fitz.TEXT_MEDIABOX_CLIP
+
+# Processes used to extract the text of several PDFs at once in batch_process
+EXTRACT_WORKERS = min(os.cpu_count() or 1, 6)
+
+def extract_text_from_pdf(pdf_path: str) -> List[Dict]:
+    """
+    Extract text from each page of the PDF with improved error handling.
+    Module level so batch_process can run it in a worker process.
+    """
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+
+    try:
+        logging.info(f"Opening PDF: {pdf_path}")
+        pdf_document = fitz.open(pdf_path)
+        pages_text = []
+        debug = logging.root.isEnabledFor(logging.DEBUG)
+
+        for page_number in range(len(pdf_document)):
+            page = pdf_document[page_number]
+            text = page.get_text("text", flags=TEXT_FLAGS, sort=False)
+            if text.strip():  # Only include non-empty pages
+                pages_text.append({
+                    "page_number": page_number + 1,
+                    "text": text
+                })
+                if debug:
+                    logging.debug(f"Extracted {len(text)} characters from page {page_number + 1}")
+
+        logging.info(f"Successfully extracted text from {len(pages_text)} pages")
+        return pages_text
+    except Exception as e:
+        logging.error(f"Error extracting text from PDF: {str(e)}")
+        raise Exception(f"Error extracting text from PDF: {str(e)}")
+    finally:
+        if 'pdf_document' in locals():
+            pdf_document.close()
+
 class DeepSeekAPI:
     """DeepSeek API client wrapper"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, refresh_cache: bool = False):
         self.api_key = api_key
         self.base_url = "https://api.deepseek.com/v1"
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        self.model = "deepseek-chat"
+        self.temperature = 0.7
+        self.max_tokens = 2000
+        # Reuse connections across requests and retry rate limits, server
+        # errors and failed connects with exponential backoff. Read errors
+        # aren't retried: the request was sent, so DeepSeek may still be
+        # generating (and billing) it
+        self.session = requests.Session()
+        retries = Retry(
+            total=5,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"]
+        )
+        adapter = HTTPAdapter(pool_connections=DEEPSEEK_CONCURRENCY, pool_maxsize=DEEPSEEK_CONCURRENCY, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers)
+        # When set, cached responses are ignored and overwritten
+        self.refresh_cache = refresh_cache
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+    def _cache_path(self, prompt: str) -> str:
+        key = hashlib.blake2b(
+            f"{self.model}|{self.temperature}|{self.max_tokens}|{prompt}".encode(),
+            digest_size=16
+        ).hexdigest()
+        return os.path.join(CACHE_DIR, f"{key}.json")
+
+    def _read_cache(self, cache_path: str):
+        try:
+            if time.time() - os.path.getmtime(cache_path) > CACHE_TTL:
+                return None
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, cache_path: str, response: Dict):
+        # Write to a temporary file so concurrent readers never see a partial entry
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR, suffix=".part", delete=False) as f:
+                json.dump(response, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(f.name, cache_path)
+        except OSError as e:
+            logging.warning(f"Could not cache DeepSeek response: {str(e)}")
 
     def chat_completion(self, prompt: str) -> Dict:
         """Send a chat completion request to DeepSeek API"""
+        cache_path = self._cache_path(prompt)
+        if not self.refresh_cache:
+            cached = self._read_cache(cache_path)
+            if cached is not None:
+                logging.debug(f"Using cached response for prompt length: {len(prompt)}")
+                return cached
+
         endpoint = f"{self.base_url}/chat/completions"
         
         payload = {
             "messages": [{"role": "user", "content": prompt}],
-            "model": "deepseek-chat",
-            "temperature": 0.7,
-            "max_tokens": 2000
+            "model": self.model,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
         }
 
         try:
             logging.debug(f"Sending request to DeepSeek API with prompt length: {len(prompt)}")
-            response = requests.post(endpoint, headers=self.headers, json=payload)
+            response = self.session.post(endpoint, json=payload, timeout=(5, DEEPSEEK_READ_TIMEOUT))
             response.raise_for_status()
-            return response.json()
+            result = response.json()
+            self._write_cache(cache_path, result)
+            return result
         except requests.exceptions.RequestException as e:
             logging.error(f"DeepSeek API request failed: {str(e)}")
             raise Exception(f"DeepSeek API request failed: {str(e)}")
 
 class PDFProcessor:
-    def __init__(self, api_key: str):
-        self.api_client = DeepSeekAPI(api_key=api_key)
+    # The fixed parts of the prompt sent with every chunk
+    PROMPT_PREFIX = "You are an advanced assistant specialized in structuring books for easy parsing. "
+    PROMPT_SUFFIX = (
+        "\n\n"
+        "Please return a valid JSON object with the following structure:\n"
+        "{\n"
+        "  \"page\": (integer) the page number,\n"
+        "  \"chapter\": (string or integer) the chapter title or number if identifiable,\n"
+        "  \"content\": (string) the main text of this page in a human-readable format,\n"
+        "  \"words\": [\n"
+        "    { \"word_number\": (integer), \"word\": (string) }"
+        "  ]\n"
+        "}\n"
+        "Ensure that:\n"
+        "1) \"content\" includes all text a human would read on this page.\n"
+        "2) \"words\" is a sequential list of all individual words from \"content\".\n"
+        "3) You preserve headings within \"content\" if they appear.\n"
+        "4) Only return valid JSON.\n"
+        "This data must be consistent so we can reconstruct a full, organized version of the book."
+    )
+
+    def __init__(self, api_key: str, refresh_cache: bool = False):
+        self.api_client = DeepSeekAPI(api_key=api_key, refresh_cache=refresh_cache)
         self.output_dir = "/Users/udaikhattar/Desktop/Development/DeepSeek Research/outputs"
         os.makedirs(self.output_dir, exist_ok=True)
         
@@ -62,136 +216,147 @@ class PDFProcessor:
         """
         Extract text from each page of the PDF with improved error handling.
         """
-        if not os.path.exists(pdf_path):
-            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-            
-        try:
-            logging.info(f"Opening PDF: {pdf_path}")
-            pdf_document = fitz.open(pdf_path)
-            pages_text = []
-
-            for page_number in range(len(pdf_document)):
-                page = pdf_document[page_number]
-                text = page.get_text("text")
-                if text.strip():  # Only include non-empty pages
-                    pages_text.append({
-                        "page_number": page_number + 1,
-                        "text": text
-                    })
-                    logging.debug(f"Extracted {len(text)} characters from page {page_number + 1}")
-
-            logging.info(f"Successfully extracted text from {len(pages_text)} pages")
-            return pages_text
-        except Exception as e:
-            logging.error(f"Error extracting text from PDF: {str(e)}")
-            raise Exception(f"Error extracting text from PDF: {str(e)}")
-        finally:
-            if 'pdf_document' in locals():
-                pdf_document.close()
+        return extract_text_from_pdf(pdf_path)
 
     def chunk_text(self, text: str, max_chunk_size: int = 4000) -> List[str]:
         """
         Split text into smaller chunks to avoid API limits.
+        Chunks are slices of the text broken at whitespace, so no word list is built.
         """
-        words = text.split()
         chunks = []
-        current_chunk = []
-        current_size = 0
-
-        for word in words:
-            word_size = len(word) + 1  # +1 for space
-            if current_size + word_size > max_chunk_size:
-                chunks.append(" ".join(current_chunk))
-                current_chunk = [word]
-                current_size = word_size
-            else:
-                current_chunk.append(word)
-                current_size += word_size
-
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
+        start = 0
+        length = len(text)
+
+        while start < length:
+            # Skip the whitespace between chunks
+            while start < length and text[start].isspace():
+                start += 1
+            end = start + max_chunk_size
+            if end < length and not text[end].isspace():
+                # Break at the last whitespace (any kind, as str.split() does)
+                # so no word is split; a word longer than the limit becomes a
+                # chunk of its own
+                split = end - 1
+                while split > start and not text[split].isspace():
+                    split -= 1
+                if split > start:
+                    end = split
+                else:
+                    while end < length and not text[end].isspace():
+                        end += 1
+            chunk = text[start:end].rstrip()
+            if chunk:
+                chunks.append(chunk)
+            start = end
 
         logging.debug(f"Split text into {len(chunks)} chunks")
         return chunks
 
-    def process_with_deepseek(self, page_number: int, text: str) -> Dict:
+    def _process_chunk(self, page_number: int, chunk_number: int, total_chunks: int, chunk: str):
         """
-        Process text chunks with DeepSeek API and combine results.
+        Send one chunk to DeepSeek; returns None if the request failed.
         """
-        chunks = self.chunk_text(text)
-        page_results = []
+        logging.info(f"Processing chunk {chunk_number}/{total_chunks} of page {page_number}")
+        
+        prompt = (
+            f"{self.PROMPT_PREFIX}Process the following content from Page {page_number}, "
+            f"chunk {chunk_number}/{total_chunks}:\n\n{chunk}{self.PROMPT_SUFFIX}"
+        )
 
-        for i, chunk in enumerate(chunks):
-            logging.info(f"Processing chunk {i+1}/{len(chunks)} of page {page_number}")
-            
-            prompt = (
-                f"You are an advanced assistant specialized in structuring books for easy parsing. "
-                f"Process the following content from Page {page_number}, chunk {i+1}/{len(chunks)}:\n\n{chunk}\n\n"
-                "Please return a valid JSON object with the following structure:\n"
-                "{\n"
-                "  \"page\": (integer) the page number,\n"
-                "  \"chapter\": (string or integer) the chapter title or number if identifiable,\n"
-                "  \"content\": (string) the main text of this page in a human-readable format,\n"
-                "  \"words\": [\n"
-                "    { \"word_number\": (integer), \"word\": (string) }"
-                "  ]\n"
-                "}\n"
-                "Ensure that:\n"
-                "1) \"content\" includes all text a human would read on this page.\n"
-                "2) \"words\" is a sequential list of all individual words from \"content\".\n"
-                "3) You preserve headings within \"content\" if they appear.\n"
-                "4) Only return valid JSON.\n"
-                "This data must be consistent so we can reconstruct a full, organized version of the book."
-            )
+        try:
+            response = self.api_client.chat_completion(prompt)
+            # Only format the previews when someone will see them
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(f"Received response for chunk {chunk_number}/{total_chunks} of page {page_number}")
+                logging.debug(f"Input chunk (first 100 chars): {chunk[:100]}...")
+                logging.debug(f"Output response (first 100 chars): {str(response)[:100]}...")
+            return response
+        except Exception as e:
+            logging.error(f"Error processing chunk {chunk_number} of page {page_number}: {str(e)}")
+            return None
 
-            try:
-                response = self.api_client.chat_completion(prompt)
-                logging.debug(f"Received response for chunk {i+1}")
-                print(f"\nInput chunk {i+1}/{len(chunks)} (first 100 chars): {chunk[:100]}...")
-                print(f"Output response (first 100 chars): {str(response)[:100]}...")
-                page_results.append(response)
-            except Exception as e:
-                logging.error(f"Error processing chunk {i+1} of page {page_number}: {str(e)}")
-                continue
+    def submit_page(self, executor: ThreadPoolExecutor, page_number: int, text: str) -> List:
+        """
+        Queue every chunk of a page on the executor; returns the futures in chunk order.
+        """
+        chunks = self.chunk_text(text)
+        return [
+            executor.submit(self._process_chunk, page_number, i + 1, len(chunks), chunk)
+            for i, chunk in enumerate(chunks)
+        ]
 
+    def collect_page(self, page_number: int, futures: List) -> Dict:
+        """
+        Wait for a page's chunk requests and combine the successful responses.
+        """
+        page_results = [response for response in (future.result() for future in futures) if response is not None]
         return {
             "page_number": page_number,
             "deepseek_output": page_results
         }
 
-    def process_pdf(self, pdf_path: str) -> Dict:
+    def process_with_deepseek(self, page_number: int, text: str) -> Dict:
+        """
+        Process text chunks with DeepSeek API and combine results.
+        """
+        with ThreadPoolExecutor(max_workers=DEEPSEEK_CONCURRENCY) as executor:
+            return self.collect_page(page_number, self.submit_page(executor, page_number, text))
+
+    def process_pdf(self, pdf_path: str, extracted_pages: List[Dict] = None) -> Dict:
         """
         Process a single PDF and return structured output.
+        Pass extracted_pages if the text has already been extracted.
         """
         try:
             pdf_name = os.path.basename(pdf_path)
             logging.info(f"Starting processing of PDF: {pdf_name}")
             
             # Extract text from PDF
-            extracted_pages = self.extract_text_from_pdf(pdf_path)
-            
-            # Process each page
-            final_results = []
-            total_pages = len(extracted_pages)
+            if extracted_pages is None:
+                extracted_pages = self.extract_text_from_pdf(pdf_path)
             
-            for i, page_data in enumerate(extracted_pages):
-                page_number = page_data["page_number"]
-                text = page_data["text"]
-                logging.info(f"Processing page {page_number}/{total_pages} of {pdf_name}")
-                page_result = self.process_with_deepseek(page_number, text)
-                final_results.append(page_result)
-                print(f"\nProcessed page {page_number}:")
-                print(json.dumps(page_result, indent=2)[:200] + "...")
-
             # Generate output filename (just PDF name + .json)
             output_file = os.path.join(
                 self.output_dir,
                 f"{os.path.splitext(pdf_name)[0]}.json"
             )
+            total_pages = len(extracted_pages)
             
-            # Save output
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(final_results, f, ensure_ascii=False, indent=2)
+            # The API calls are network bound, so queue the chunks of every
+            # page at once and let the pool keep DEEPSEEK_CONCURRENCY in flight
+            with ThreadPoolExecutor(max_workers=DEEPSEEK_CONCURRENCY) as executor:
+                pending = deque()
+                for page_data in extracted_pages:
+                    page_number = page_data["page_number"]
+                    logging.info(f"Queueing page {page_number}/{total_pages} of {pdf_name}")
+                    pending.append((page_number, self.submit_page(executor, page_number, page_data["text"])))
+                
+                # Write each page as soon as it is complete so only pages still
+                # in flight are held in memory. ContentStitcher is the only
+                # reader; a failed run never leaves a truncated array behind.
+                temp_file = output_file + ".part"
+                try:
+                    with open(temp_file, "w", encoding="utf-8") as f:
+                        f.write("[")
+                        separator = ""
+                        while pending:
+                            page_number, futures = pending.popleft()
+                            page_result = self.collect_page(page_number, futures)
+                            f.write(separator)
+                            json.dump(page_result, f, ensure_ascii=False, separators=(',', ':'))
+                            separator = ",\n"
+                            if logging.root.isEnabledFor(logging.DEBUG):
+                                logging.debug(f"Processed page {page_number}: {json.dumps(page_result, ensure_ascii=False)[:200]}...")
+                        f.write("]")
+                    os.replace(temp_file, output_file)
+                except BaseException:
+                    # Don't start any requests that are still queued
+                    for _, futures in pending:
+                        for future in futures:
+                            future.cancel()
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+                    raise
             
             logging.info(f"Processing complete for {pdf_name}. Output saved to {output_file}")
             return {"pdf_name": pdf_name, "output_file": output_file, "pages_processed": total_pages}
@@ -212,17 +377,44 @@ class PDFProcessor:
         logging.info(f"Found {len(pdf_files)} PDF files to process")
         results = []
 
-        for pdf_file in pdf_files:
-            result = self.process_pdf(pdf_file)
-            results.append(result)
-            
-            # Print summary after each PDF
-            if "error" in result:
-                print(f"\nFailed to process {result['pdf_name']}: {result['error']}")
-            else:
-                print(f"\nSuccessfully processed {result['pdf_name']}:")
-                print(f"- Pages processed: {result['pages_processed']}")
-                print(f"- Output saved to: {result['output_file']}")
+        # Extraction is CPU bound, so extract the PDFs on a process pool while
+        # the API calls for earlier PDFs are running. Only a few PDFs are
+        # extracted ahead, so the text of the whole batch is never held at once.
+        workers = min(EXTRACT_WORKERS, len(pdf_files))
+        remaining = iter(pdf_files)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker_logging,
+            initargs=(log_queue,)
+        ) as executor:
+            extractions = deque(
+                (pdf_file, executor.submit(extract_text_from_pdf, pdf_file))
+                for pdf_file in islice(remaining, workers)
+            )
+
+            while extractions:
+                pdf_file, extraction = extractions.popleft()
+                # Refill the freed slot so the next extraction overlaps this PDF's API calls
+                next_file = next(remaining, None)
+                if next_file is not None:
+                    extractions.append((next_file, executor.submit(extract_text_from_pdf, next_file)))
+
+                try:
+                    result = self.process_pdf(pdf_file, extraction.result())
+                except Exception as e:
+                    logging.error(f"Error processing PDF {pdf_file}: {str(e)}")
+                    result = {"pdf_name": os.path.basename(pdf_file), "error": str(e)}
+                # The future holds this PDF's text; let it go before the next one
+                del extraction
+                results.append(result)
+                
+                # Print summary after each PDF
+                if "error" in result:
+                    print(f"\nFailed to process {result['pdf_name']}: {result['error']}")
+                else:
+                    print(f"\nSuccessfully processed {result['pdf_name']}:")
+                    print(f"- Pages processed: {result['pages_processed']}")
+                    print(f"- Output saved to: {result['output_file']}")
 
         return results
 
@@ -230,8 +422,8 @@ def main():
     # Get API key from environment variable
     api_key = os.getenv("DEEPSEEK_API_KEY", "sk-aa8698fcc31048a4a1a33a8ff378a4b2")
     
-    # Initialize processor
-    processor = PDFProcessor(api_key)
+    # Initialize processor; --no-cache forces fresh API responses
+    processor = PDFProcessor(api_key, refresh_cache="--no-cache" in sys.argv[1:])
     
     # Get input pattern from user or use default
     default_pattern = os.path.join(os.getcwd(), "*.pdf")
@@ -1,13 +1,15 @@
 import os
 import json
+import tempfile
 import logging
+from operator import itemgetter
 
 # Get base directory
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO),
     format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
     handlers=[
         logging.FileHandler(os.path.join(BASE_DIR, 'content_stitching.log')),
@@ -16,6 +18,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def parse_message_content(message_content):
+    """Decode the JSON in a DeepSeek message, allowing for a ```json code fence"""
+    text = message_content.strip()
+    if text.startswith('```'):
+        # Drop the opening fence line and the closing fence
+        text = text[text.find('\n') + 1:] if '\n' in text else text[3:]
+        if text.endswith('```'):
+            text = text[:-3]
+    return json.loads(text)
+
 class ContentStitcher:
     def __init__(self):
         self.output_dir = os.path.join(BASE_DIR, 'stitched_content')
@@ -40,27 +52,66 @@ class ContentStitcher:
             with open(json_path, 'r', encoding='utf-8') as f:
                 pages_data = json.load(f)
             
-            # Sort pages by page number
-            pages_data.sort(key=lambda x: x['page_number'])
+            # Sort pages by page number; pdf_processor writes them in order,
+            # which makes this a single linear pass
+            pages_data.sort(key=itemgetter('page_number'))
+            
+            return self.stitch_pages(pages_data, output_path) is not None
             
-            with open(output_path, 'w', encoding='utf-8') as f:
+        except Exception as e:
+            logger.exception(f"Error in stitch_content: {str(e)}")
+            return False
+
+    def stitch_pages(self, pages_data, output_path):
+        """Write the content of pages (any iterable, in page order) to a text file
+
+        Returns the number of whitespace-separated words written, or None on failure.
+        """
+        # Write to a temporary file first so a failure never leaves a partial
+        # text file that looks like a finished book. The name is unique so
+        # two workers stitching the same book don't write into one file
+        temp_path = None
+        word_count = 0
+        try:
+            with tempfile.NamedTemporaryFile(
+                'w', encoding='utf-8', dir=os.path.dirname(output_path) or '.',
+                suffix='.part', delete=False
+            ) as f:
+                temp_path = f.name
                 for page_data in pages_data:
+                    # Pages extracted in-process carry their text directly
+                    if 'text' in page_data:
+                        text = page_data['text'].strip()
+                        if text:
+                            word_count += len(text.split())
+                            f.write(text)
+                            f.write('\n\n')  # Add spacing between pages
+                        continue
+                    
                     for response in page_data['deepseek_output']:
                         try:
+                            # DeepSeek responses carry the page as a JSON string
                             message_content = response['choices'][0]['message']['content']
-                            content_data = json.loads(message_content)
+                            content_data = parse_message_content(message_content)
                             
                             # Write the content
                             if content_data.get('content'):
-                                f.write(content_data['content'].strip())
+                                text = content_data['content'].strip()
+                                word_count += len(text.split())
+                                f.write(text)
                                 f.write('\n\n')  # Add spacing between pages
                         except (json.JSONDecodeError, KeyError) as e:
                             logger.warning(f"Error processing page {page_data['page_number']}: {str(e)}")
                             continue
             
+            # Temporary files are created owner-only; nginx may need to read it
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, output_path)
             logger.info(f"Successfully created {output_path}")
-            return True
+            return word_count
             
         except Exception as e:
-            logger.exception(f"Error in stitch_content: {str(e)}")
-            return False 
\ No newline at end of file
+            logger.exception(f"Error in stitch_pages: {str(e)}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
\ No newline at end of file
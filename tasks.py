@@ -0,0 +1,36 @@
+from celery import Celery
+from celery.signals import worker_process_init
+from kombu import Queue
+from config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND, CELERY_TASK_ALWAYS_EAGER, REDIS_SOCKET_TIMEOUT
+
+celery = Celery('flashreader', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+celery.conf.update(
+    task_track_started=True,  # Report STARTED so the status endpoint can show 'processing'
+    task_always_eager=CELERY_TASK_ALWAYS_EAGER,
+    # Web workers look up task state while polling; don't hang when Redis is down
+    redis_socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    redis_socket_timeout=REDIS_SOCKET_TIMEOUT,
+    # PDF jobs are long and CPU bound: hand them out one at a time, and
+    # recycle worker processes regularly since PyMuPDF memory creeps up
+    worker_prefetch_multiplier=1,
+    worker_max_tasks_per_child=20,
+    # Keep CPU-heavy extraction on its own queue so it can get dedicated workers
+    task_queues=(Queue('pdf', routing_key='pdf.extract'),),
+    task_routes={'tasks.process_pdf_task': {'queue': 'pdf', 'routing_key': 'pdf.extract'}},
+    task_default_queue='pdf'
+)
+
+@worker_process_init.connect
+def warm_worker(**kwargs):
+    """Import the app and warm up PyMuPDF before the first task arrives"""
+    # app warms PyMuPDF when it is imported
+    import app  # noqa: F401
+
+@celery.task(bind=True)
+def process_pdf_task(self, book_id):
+    """Process an uploaded PDF on a worker instead of the request thread"""
+    # Imported here to avoid a circular import (app enqueues this task)
+    from app import app, process_pdf
+
+    with app.app_context():
+        return process_pdf(book_id)